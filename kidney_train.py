@@ -27,101 +27,201 @@ Original Paper:
 """
 import time
 import os
+import numpy as np
 import pandas as pd
 import tensorflow as tf
+from tensorflow.python.tools import optimize_for_inference_lib
 
 try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
 
-def image_augmentation(image, mask):
-    """Returns (maybe) augmented images
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+BN_EPSILON = 1e-3
+
+def augment_batch(images, masks):
+    """Returns (maybe) augmented batch of images
 
     (1) Random flip (left <--> right)
     (2) Random flip (up <--> down)
     (3) Random brightness
     (4) Random hue
 
+    Flips are drawn per example but applied to the whole batch at once.
+
     Args:
-        image (3-D Tensor): Image tensor of (H, W, C)
-        mask (3-D Tensor): Mask image tensor of (H, W, 1)
+        images (4-D Tensor): Image tensor of (N, H, W, C)
+        masks (4-D Tensor): Mask image tensor of (N, H, W, 1)
 
     Returns:
-        image: Maybe augmented image (same shape as input `image`)
-        mask: Maybe augmented mask (same shape as input `mask`)
+        images: Maybe augmented images (same shape as input `images`)
+        masks: Maybe augmented masks (same shape as input `masks`)
+    """
+    concat_image = tf.concat([images, masks], axis=-1)
+    batch_size = tf.shape(concat_image)[0]
+
+    for axis in (2, 1):
+        flip = tf.random_uniform([batch_size]) < 0.5
+        concat_image = tf.where(flip, tf.reverse(concat_image, [axis]),
+                                concat_image)
+
+    images = concat_image[..., :-1]
+    masks = concat_image[..., -1:]
+
+    images = tf.image.random_brightness(images, 0.7)
+    images = tf.image.random_hue(images, 0.3)
+
+    return images, masks
+
+
+def decode_resize(contents, channels, height=None, width=None,
+                  method=tf.image.ResizeMethod.AREA):
+    """Returns an image decoded from `contents` and resized to (height, width)
+
+    Args:
+        contents (0-D Tensor): encoded PNG, JPEG, GIF or BMP
+        channels (int): number of color channels
+        height, width (int, optional): target size, if given
+        method: `tf.image.ResizeMethod` used when the sizes differ
+
+    Returns
+        image (3-D uint8 Tensor): (height, width, channels)
     """
-    concat_image = tf.concat([image, mask], axis=-1)
+    image = tf.image.decode_image(contents, channels=channels,
+                                  expand_animations=False)
+    if height is None or width is None:
+        return image
 
-    maybe_flipped = tf.image.random_flip_left_right(concat_image)
-    maybe_flipped = tf.image.random_flip_up_down(concat_image)
+    image = tf.image.resize_images(image, (height, width), method=method)
+    image = tf.saturate_cast(tf.round(image), tf.uint8)
+    image.set_shape([height, width, channels])
 
-    image = maybe_flipped[:, :, :-1]
-    mask = maybe_flipped[:, :, -1:]
+    return image
 
-    image = tf.image.random_brightness(image, 0.7)
-    image = tf.image.random_hue(image, 0.3)
+
+def read_image_mask(image_path, mask_path, height=None, width=None):
+    """Returns decoded `image` and `mask` for a pair of file paths
+
+    Images larger (or smaller) than (height, width) are resized right
+    after decoding, so only target size tensors are cached and batched.
+    Masks are resized with nearest neighbor to keep the labels intact.
+
+    Args:
+        image_path (0-D Tensor): path to the image
+        mask_path (0-D Tensor): path to the mask
+        height, width (int, optional): target size
+
+    Returns
+        image (3-D uint8 Tensor): (H, W, 3)
+        mask (3-D uint8 Tensor): (H, W, 1)
+    """
+    image_file = tf.read_file(image_path)
+    mask_file = tf.read_file(mask_path)
+
+    image = decode_resize(image_file, 3, height=height, width=width)
+    mask = decode_resize(mask_file, 1, height=height, width=width,
+                         method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
 
     return image, mask
 
 
+def preprocess_batch(images, masks, classes=1, augmentation=False):
+    """Returns model-ready `images` and `masks`, (maybe) augmented
+
+    Images are scaled to [-1, 1] and masks one-hot encoded here, on the
+    input pipeline, so the model does not repeat it every step.
+
+    Args:
+        images (4-D uint8 Tensor): (N, H, W, 3)
+        masks (4-D uint8 Tensor): (N, H, W, 1) class labels
+        classes (int): number of classes for the one-hot masks
+        augmentation (bool): If True, apply `augment_batch`
 
-def get_image_mask(queue, data_root = tf.Variable("", trainable=False),
+    Returns:
+        images (4-D Tensor): (N, H, W, 3) in [-1, 1]
+        masks (4-D Tensor): (N, H, W, classes)
+    """
+    images = tf.cast(images, tf.float32)
+    masks = tf.cast(masks, tf.float32)
+
+    if augmentation:
+        images, masks = augment_batch(images, masks)
+
+    images = images * (1. / 127.5) - 1.
+    masks = tf.one_hot(tf.cast(masks[..., 0], tf.int32), depth=classes)
+
+    return images, masks
+
+
+def get_image_mask(csv_file, data_root="",
+                   classes=1,
+                   batch_size=16,
                    augmentation=True,
-                   img_decoder = tf.image.decode_png,
+                   shuffle=True,
+                   shuffle_buffer=256,
+                   cache="",
                    height=None, width=None):
-    """Returns `image` and `mask`
+    """Returns a `tf.data.Dataset` of (`image`, `mask`) batches and its row count
     Input pipeline:
-        Queue -> CSV -> FileRead -> Decode JPEG
-    (1) Queue contains a CSV filename
-    (2) Text Reader opens the CSV
-        CSV file contains two columns
-        ["path/to/image.jpg", "path/to/mask.jpg"]
-    (3) File Reader opens both files
-    (4) Decode JPEG to tensors
+        CSV -> Shuffle -> FileRead -> Decode -> Cache -> Shuffle -> Batch
+            -> Augment -> Prefetch
+    (1) CSV file contains two columns
+        ["path/to/image.png", "path/to/mask.png"]
+    (2) File paths are shuffled over the whole CSV (optional)
+    (3) Both files are read and decoded in parallel
+    (4) Decoded uint8 tensors are cached to `cache`
+        (a file name, or "" to keep them in memory)
+        so files are decoded only in the first epoch
+    (5) Decoded examples are reshuffled every epoch through a
+        `shuffle_buffer` sized buffer (optional)
+    (6) Whole batches are cast to float32 and augmented at once (optional),
+        then images are scaled to [-1, 1] and masks one-hot encoded
+    (7) The dataset repeats indefinitely so the cache outlives an epoch;
+        an epoch is ceil(n_rows / batch_size) batches
+    (8) Batches are prefetched to overlap with training
     Notes:
         height, width = 640, 960
     Returns
-        image (3-D Tensor): (640, 960, 3)
-        mask (3-D Tensor): (640, 960, 1)
+        dataset: yields
+            image (4-D Tensor): (N, 640, 960, 3)
+            mask (4-D Tensor): (N, 640, 960, classes)
+        n_rows (int): number of examples in one pass
     """
-    text_reader = tf.TextLineReader(skip_header_lines=1)
-    _, csv_content = text_reader.read(queue)
-
-    image_path, mask_path = tf.decode_csv(csv_content, 
-                                          record_defaults=[[""], [""]]
-                                          )
+    files = pd.read_csv(csv_file)
+    # prefix once here rather than with a string op per example
+    image_paths = (data_root + files.iloc[:, 0].astype(str)).values
+    mask_paths = (data_root + files.iloc[:, 1].astype(str)).values
 
-    image_path = tf.add(data_root, image_path)
-    mask_path = tf.add(data_root, mask_path)
+    ds = tf.data.Dataset.from_tensor_slices((image_paths, mask_paths))
+    if shuffle:
+        ds = ds.shuffle(len(files), reshuffle_each_iteration=True)
 
-    image_file = tf.read_file(image_path)
-    mask_file = tf.read_file(mask_path)
+    def load_and_decode(image_path, mask_path):
+        return read_image_mask(image_path, mask_path,
+                               height=height, width=width)
 
-    image = img_decoder(image_file, channels=3)
-    if height is not None and width is not None:
-        image.set_shape([height, width, 3])
-    image = tf.cast(image, tf.float32)
+    def preprocess(images, masks):
+        return preprocess_batch(images, masks, classes=classes,
+                                augmentation=augmentation)
 
-    mask = img_decoder(mask_file, channels=1)
-    if height is not None and width is not None:
-        mask.set_shape([height, width, 1])
-    mask = tf.cast(mask, tf.float32)
-    #mask = mask / (tf.reduce_max(mask) + 1e-7)
+    ds = ds.map(load_and_decode, num_parallel_calls=AUTOTUNE)
+    ds = ds.cache(cache)
+    if shuffle:
+        # the cache replays the first epoch in order
+        ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
 
-    if augmentation:
-        image, mask = image_augmentation(image, mask)
+    ds = ds.batch(batch_size)
+    ds = ds.map(preprocess, num_parallel_calls=AUTOTUNE)
 
-    return image, mask
+    ds = ds.repeat().prefetch(AUTOTUNE)
 
-def get_line_num(infile):
-    nlines = 0
-    with open(infile) as fh:
-        for _ in fh:
-            nlines += 1
-    return nlines
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    return ds.with_options(options), len(files)
 
-def conv_conv_pool(input_, n_filters, training, name, pool=True, activation=tf.nn.relu):
+def conv_conv_pool(input_, n_filters, training, name, pool=True, activation=tf.nn.relu,
+                   batch_norm=True, data_format="channels_last"):
     """{Conv -> BN -> RELU}x2 -> {Pool, optional}
 
     Args:
@@ -131,72 +231,99 @@ def conv_conv_pool(input_, n_filters, training, name, pool=True, activation=tf.n
         name (str): name postfix
         pool (bool): If True, MaxPool2D
         activation: Activaion functions
+        batch_norm (bool): If False, BN is skipped (weights were folded)
+        data_format (str): "channels_last" (NHWC) or "channels_first" (NCHW)
 
     Returns:
         net: output of the Convolution operations
         pool (optional): output of the max pooling operations
     """
     net = input_
+    axis = 1 if data_format == "channels_first" else -1
 
     with tf.variable_scope("layer{}".format(name)):
         for i, F in enumerate(n_filters):
-            net = tf.layers.conv2d(net, F, (3, 3), activation=None, padding='same', name="conv_{}".format(i + 1))
-            net = tf.layers.batch_normalization(net, training=training, name="bn_{}".format(i + 1))
+            # BN subtracts the mean right away, a conv bias would be a no-op
+            net = tf.layers.conv2d(net, F, (3, 3), activation=None, padding='same',
+                                   use_bias=not batch_norm, data_format=data_format,
+                                   name="conv_{}".format(i + 1))
+            if batch_norm:
+                net = tf.layers.batch_normalization(net, axis=axis, training=training, fused=True,
+                                                    epsilon=BN_EPSILON, name="bn_{}".format(i + 1))
             net = activation(net, name="relu{}_{}".format(name, i + 1))
 
         if pool is False:
             return net
 
-        pool = tf.layers.max_pooling2d(net, (2, 2), strides=(2, 2), name="pool_{}".format(name))
+        pool = tf.layers.max_pooling2d(net, (2, 2), strides=(2, 2), data_format=data_format,
+                                       name="pool_{}".format(name))
 
         return net, pool
 
 
-def upsample_concat(inputA, input_B, name):
-    """Upsample `inputA` and concat with `input_B`
+def upsample_add(inputA, input_B, name, data_format="channels_last"):
+    """Upsample `inputA` and add it to `input_B`
 
     Args:
         input_A (4-D Tensor): (N, H, W, C)
         input_B (4-D Tensor): (N, 2*H, 2*H, C2)
-        name (str): name of the concat operation
+        name (str): name of the add operation
+        data_format (str): "channels_last" (NHWC) or "channels_first" (NCHW)
 
     Returns:
-        output (4-D Tensor): (N, 2*H, 2*W, C + C2)
+        output (4-D Tensor): (N, 2*H, 2*W, C2)
     """
-    upsample = upsampling_2D(inputA, size=(2, 2), name=name)
+    axis = 1 if data_format == "channels_first" else -1
+    channels = input_B.get_shape().as_list()[axis]
+    upsample = upsampling_2D(inputA, channels, size=(2, 2), name=name,
+                             data_format=data_format)
 
-    return tf.concat([upsample, input_B], axis=-1, name="concat_{}".format(name))
+    return tf.add(upsample, input_B, name="add_{}".format(name))
 
 
-def upsampling_2D(tensor, name, size=(2, 2)):
-    """Upsample/Rescale `tensor` by size
+def upsampling_2D(tensor, n_filters, name, size=(2, 2), data_format="channels_last"):
+    """Upsample `tensor` by size with a pixel shuffle
+
+    A 3x3 convolution produces `n_filters * block**2` channels which
+    `depth_to_space` rearranges into a `block` times larger image.
 
     Args:
         tensor (4-D Tensor): (N, H, W, C)
+        n_filters (int): number of output channels
         name (str): name of upsampling operations
         size (tuple, optional): (height_multiplier, width_multiplier)
             (default: (2, 2))
+        data_format (str): "channels_last" (NHWC) or "channels_first" (NCHW)
 
     Returns:
-        output (4-D Tensor): (N, h_multiplier * H, w_multiplier * W, C)
+        output (4-D Tensor): (N, h_multiplier * H, w_multiplier * W, n_filters)
     """
-    H, W, _ = tensor.get_shape().as_list()[1:]
-
     H_multi, W_multi = size
-    target_H = H * H_multi
-    target_W = W * W_multi
+    if H_multi != W_multi:
+        raise ValueError("depth_to_space needs a square size but {} was given".format(size))
+
+    net = tf.layers.conv2d(tensor, n_filters * H_multi * W_multi, (3, 3),
+                           padding='same', data_format=data_format,
+                           name="upconv_{}".format(name))
 
-    return tf.image.resize_nearest_neighbor(tensor, (target_H, target_W), name="upsample_{}".format(name))
+    return tf.depth_to_space(net, H_multi, name="upsample_{}".format(name),
+                             data_format="NCHW" if data_format == "channels_first" else "NHWC")
 
 
 def make_unet(X, training,
                 activation=tf.nn.sigmoid,
-                classes=1):
+                classes=1,
+                batch_norm=True,
+                data_format="channels_last"):
     """Build a U-Net architecture
 
     Args:
-        X (4-D Tensor): (N, H, W, C)
+        X (4-D Tensor): (N, H, W, C) image scaled to [-1, 1]
         training (1-D Tensor): Boolean Tensor is required for batchnormalization layers
+        batch_norm (bool): If False, build the BN-free graph for folded weights
+        data_format (str): layout used inside the network, "channels_first"
+            (NCHW) picks the faster cuDNN kernels on GPU. Input and output
+            are always NHWC.
 
     Returns:
         output (4-D Tensor): (N, H, W, C)
@@ -206,66 +333,85 @@ def make_unet(X, training,
         U-Net: Convolutional Networks for Biomedical Image Segmentation
         https://arxiv.org/abs/1505.04597
     """
-    net = X / 127.5 - 1
-    net = tf.layers.conv2d(net, 3, (1, 1), name="color_space_adjust")
-    conv1, pool1 = conv_conv_pool(net, [8, 8], training, name=1)
-    conv2, pool2 = conv_conv_pool(pool1, [16, 16], training, name=2)
-    conv3, pool3 = conv_conv_pool(pool2, [32, 32], training, name=3)
-    conv4, pool4 = conv_conv_pool(pool3, [64, 64], training, name=4)
-    conv5 = conv_conv_pool(pool4, [128, 128], training, name=5, pool=False)
-
-    up6 = upsample_concat(conv5, conv4, name=6)
-    conv6 = conv_conv_pool(up6, [64, 64], training, name=6, pool=False)
-
-    up7 = upsample_concat(conv6, conv3, name=7)
-    conv7 = conv_conv_pool(up7, [32, 32], training, name=7, pool=False)
-
-    up8 = upsample_concat(conv7, conv2, name=8)
-    conv8 = conv_conv_pool(up8, [16, 16], training, name=8, pool=False)
+    net = X
+    if data_format == "channels_first":
+        net = tf.transpose(net, [0, 3, 1, 2])
+
+    net = tf.layers.conv2d(net, 3, (1, 1), data_format=data_format, name="color_space_adjust")
+    conv1, pool1 = conv_conv_pool(net, [8, 8], training, name=1,
+                                  batch_norm=batch_norm, data_format=data_format)
+    conv2, pool2 = conv_conv_pool(pool1, [16, 16], training, name=2,
+                                  batch_norm=batch_norm, data_format=data_format)
+    conv3, pool3 = conv_conv_pool(pool2, [32, 32], training, name=3,
+                                  batch_norm=batch_norm, data_format=data_format)
+    conv4, pool4 = conv_conv_pool(pool3, [64, 64], training, name=4,
+                                  batch_norm=batch_norm, data_format=data_format)
+    conv5 = conv_conv_pool(pool4, [128, 128], training, name=5, pool=False,
+                           batch_norm=batch_norm, data_format=data_format)
+
+    up6 = upsample_add(conv5, conv4, name=6, data_format=data_format)
+    conv6 = conv_conv_pool(up6, [64, 64], training, name=6, pool=False,
+                           batch_norm=batch_norm, data_format=data_format)
+
+    up7 = upsample_add(conv6, conv3, name=7, data_format=data_format)
+    conv7 = conv_conv_pool(up7, [32, 32], training, name=7, pool=False,
+                           batch_norm=batch_norm, data_format=data_format)
+
+    up8 = upsample_add(conv7, conv2, name=8, data_format=data_format)
+    conv8 = conv_conv_pool(up8, [16, 16], training, name=8, pool=False,
+                           batch_norm=batch_norm, data_format=data_format)
+
+    up9 = upsample_add(conv8, conv1, name=9, data_format=data_format)
+    conv9 = conv_conv_pool(up9, [8, 8], training, name=9, pool=False,
+                           batch_norm=batch_norm, data_format=data_format)
+
+    net = tf.layers.conv2d(conv9, classes, (1, 1), name='final',
+                           data_format=data_format, padding='same')
+    if data_format == "channels_first":
+        net = tf.transpose(net, [0, 2, 3, 1])
+
+    # activation runs on NHWC so softmax normalizes over the classes
+    return activation(net, name="pred")
 
-    up9 = upsample_concat(conv8, conv1, name=9)
-    conv9 = conv_conv_pool(up9, [8, 8], training, name=9, pool=False)
 
-    return tf.layers.conv2d(conv9, classes, (1, 1), name='final',
-                            activation=activation, padding='same')
+def sparse_iou(y_pred, y_true):
+    """Returns a (approx) IOU score averaged over classes
 
+    Args:
+        y_pred (4-D array): (N, H, W, C) class probabilities
+        y_true (4-D array): (N, H, W, C) one-hot class labels
 
-def sparse_iou(y_pred, y_true):
-    channels = y_pred.shape[-1]
-    iou_ = []
-    for cc in range(channels):
-        iou_.append(  IOU_(y_pred[:,:,:,cc], tf.equal(y_true,cc)) )
-    return tf.reduce_mean(iou_, name='iou', axis=0)
+    Returns:
+        float: IOU score
+    """
+    return tf.identity(IOU_(y_pred, y_true), name='iou')
 
 def IOU_(y_pred, y_true):
     """Returns a (approx) IOU score
 
-    intesection = y_pred.flatten() * y_true.flatten()
+    intesection = (y_pred * y_true).sum(axis=(H, W))
     Then, IOU = 2 * intersection / (y_pred.sum() + y_true.sum() + 1e-7) + 1e-7
 
+    The score is computed per example and channel, then averaged.
+
     Args:
-        y_pred (4-D array): (N, H, W, 1)
-        y_true (4-D array): (N, H, W, 1)
+        y_pred (4-D array): (N, H, W, C)
+        y_true (4-D array): (N, H, W, C)
 
     Returns:
         float: IOU score
     """
-    H, W = y_pred.get_shape().as_list()[1:3]
-
-    pred_flat = tf.reshape(y_pred, [-1, H * W])
-    true_flat = tf.reshape(y_true, [-1, H * W])
+    y_true = tf.cast(y_true, tf.float32)
 
-    true_flat = tf.cast(true_flat, tf.float32)
-    intersection =  tf.reduce_sum(2*pred_flat * true_flat, axis=1, name='intersection') + 1e-7
-    #true_flat = tf.cast(true_flat, tf.bool)
-    #intersection = 2 * tf.reduce_sum(tf.boolean_mask(pred_flat, true_flat), axis=1) + 1e-7
-    denominator = tf.reduce_sum(pred_flat, axis=1) + tf.cast(tf.reduce_sum(true_flat, axis=1), tf.float32) + 1e-7
+    intersection = 2 * tf.reduce_sum(y_pred * y_true, axis=[1, 2], name='intersection') + 1e-7
+    denominator = tf.reduce_sum(y_pred, axis=[1, 2]) + tf.reduce_sum(y_true, axis=[1, 2]) + 1e-7
 
     return tf.reduce_mean(intersection / denominator)
 
 
 def make_train_op(y_pred, y_true,
-        learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-08):
+        learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-08,
+        mixed_precision=False, jit=False):
     """Returns a training operation
 
     Loss function = - IOU(y_pred, y_true)
@@ -277,20 +423,127 @@ def make_train_op(y_pred, y_true,
         (the area of two boxes)
 
     Args:
-        y_pred (4-D Tensor): (N, H, W, 1)
-        y_true (4-D Tensor): (N, H, W, 1)
+        y_pred (4-D Tensor): (N, H, W, C)
+        y_true (4-D Tensor): (N, H, W, C) one-hot
+        mixed_precision (bool): If True, run convolutions in float16
+            with dynamic loss scaling. This includes the `final` conv, and
+            a sigmoid output follows it in float16; softmax and the IOU
+            reductions stay float32
+        jit (bool): If True, XLA-compile the loss, the gradients and the
+            Adam updates. The updates are only compiled for resource
+            variables (see `tf.enable_resource_variables`)
 
     Returns:
         train_op: minimize operation
     """
-    #loss = -IOU_(y_pred, y_true)
-    loss = -sparse_iou(y_pred, y_true)
-
     global_step = tf.train.get_or_create_global_step()
 
     optim = tf.train.AdamOptimizer(learning_rate=learning_rate, beta1=beta1,
                                    beta2=beta2, epsilon=epsilon)
-    return optim.minimize(loss, global_step=global_step)
+    if mixed_precision:
+        # the AMP rewrite casts every conv (the `final` one too) to float16;
+        # Softmax, Sum and Mean are kept in float32, Sigmoid is not
+        optim = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+            optim, loss_scale="dynamic")
+
+    with tf.xla.experimental.jit_scope(compile_ops=jit):
+        #loss = -IOU_(y_pred, y_true)
+        loss = -sparse_iou(y_pred, y_true)
+        return optim.minimize(loss, global_step=global_step)
+
+
+def fold_batch_norm(sess, epsilon=BN_EPSILON):
+    """Returns model weights with batch normalization folded into the convolutions
+
+    For every `layer{k}/conv_{i}` followed by `layer{k}/bn_{i}`
+
+        scale = gamma / sqrt(moving_variance + epsilon)
+        kernel = kernel * scale
+        bias = scale * (bias - moving_mean) + beta
+
+    Convolutions followed by BN are trained without a bias, which is 0 then.
+
+    Args:
+        sess (tf.Session): Session holding the trained model
+        epsilon (float): epsilon of the batchnormalization layers
+
+    Returns:
+        dict: {variable name: numpy array} for the model built with `batch_norm=False`
+    """
+    with sess.graph.as_default():
+        variables = tf.trainable_variables() + [
+            var for var in tf.global_variables() if "moving_" in var.op.name]
+    values = dict(zip([var.op.name for var in variables], sess.run(variables)))
+
+    for name in list(values):
+        scope, _, kind = name.rpartition("/")
+        bn_scope = scope.replace("/conv_", "/bn_")
+        if kind != "kernel" or bn_scope == scope or bn_scope + "/gamma" not in values:
+            continue
+
+        scale = values[bn_scope + "/gamma"] / np.sqrt(values[bn_scope + "/moving_variance"] + epsilon)
+        values[name] = values[name] * scale
+        bias = values.get(scope + "/bias", 0.)
+        values[scope + "/bias"] = scale * (bias - values[bn_scope + "/moving_mean"]) + values[bn_scope + "/beta"]
+
+    return values
+
+
+def save_folded_model(sess, path, input_shape, activation=tf.nn.sigmoid, classes=1,
+                      frozen_path=None, frozen_input_shape=None):
+    """Saves an inference-only copy of the model with batchnorm folded in
+
+    The exported graph takes raw pixels in [0, 255] and scales them itself.
+
+    If `frozen_path` is given, the same model is also written as a frozen
+    GraphDef: variables become constants, training-only nodes are
+    stripped and constants are folded for the fixed `frozen_input_shape`.
+
+    Args:
+        sess (tf.Session): Session holding the trained model
+        path (str): checkpoint path
+        input_shape (list): shape of the checkpoint's input placeholder (N, H, W, C)
+        activation: activation of the final layer
+        classes (int): number of output channels
+        frozen_path (str, optional): path of the frozen `.pb` graph
+        frozen_input_shape (list, optional): input shape the frozen graph
+            is specialized to (default: `input_shape`)
+    """
+    values = fold_batch_norm(sess)
+
+    def build(shape):
+        X = tf.placeholder(tf.float32, shape=shape, name="X")
+        pred = make_unet(X * (1. / 127.5) - 1., False,
+                         activation=activation, classes=classes,
+                         batch_norm=False)
+
+        for var in tf.global_variables():
+            var.load(values[var.op.name], tf.get_default_session())
+        return X, pred
+
+    with tf.Graph().as_default(), tf.Session() as folded_sess:
+        X, pred = build(input_shape)
+
+        tf.add_to_collection("inputs", X)
+        tf.add_to_collection("outputs", pred)
+
+        tf.train.Saver().save(folded_sess, path)
+
+    if frozen_path is None:
+        return
+
+    with tf.Graph().as_default(), tf.Session() as folded_sess:
+        X, pred = build(frozen_input_shape or input_shape)
+
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            folded_sess, folded_sess.graph_def, [pred.op.name])
+
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def, [X.op.name], [pred.op.name], tf.float32.as_datatype_enum)
+
+    tf.train.write_graph(graph_def, os.path.dirname(frozen_path),
+                         os.path.basename(frozen_path), as_text=False)
 
 
 def read_flags():
@@ -357,22 +610,79 @@ def read_flags():
                         default="models",
                         help="Checkpoint directory (default: models)")
 
+    parser.add_argument("--shuffle-buffer",
+                        default=256,
+                        type=int,
+                        help="Number of decoded images to shuffle over (default: 256)")
+
+    parser.add_argument("--cache",
+                        default="",
+                        type=str,
+                        help="file to cache decoded training images (default: in memory)")
+
+    parser.add_argument("--log-every",
+                        default=100,
+                        type=int,
+                        help="Log the prediction histogram every n steps (default: 100)")
+
+    parser.add_argument("--data-format",
+                        default=None,
+                        choices=["channels_first", "channels_last"],
+                        help="Layout inside the network "
+                             "(default: channels_first on GPU, channels_last otherwise)")
+
+    parser.add_argument("--no-xla",
+                        dest="xla",
+                        action="store_false",
+                        help="Disable XLA JIT compilation of the graph")
+
+    parser.add_argument("--no-mixed-precision",
+                        dest="mixed_precision",
+                        action="store_false",
+                        help="Train in float32 instead of mixed float16")
+
     flags = parser.parse_args()
     return flags
 
 
 def main(flags):
-    n_train = get_line_num(flags.train)
-    n_test = get_line_num(flags.test)
-
     current_time = time.strftime("%m/%d/%H/%M/%S")
     train_logdir = os.path.join(flags.logdir, "train", current_time)
     test_logdir = os.path.join(flags.logdir, "test", current_time)
 
     tf.reset_default_graph()
-    X = tf.placeholder(tf.float32, shape=[None, flags.height, flags.w, 3], name="X")
-    y = tf.placeholder(tf.float32, shape=[None, flags.height, flags.w, 1],
-                       name="y")
+    # resource variables make Adam emit ResourceApplyAdam, which XLA can
+    # compile; ref-variable ApplyAdam ops stay outside the jit_scope clusters
+    tf.enable_resource_variables()
+
+    train_ds, n_train = get_image_mask(flags.train, data_root=flags.data_root,
+                                       classes=flags.channels,
+                                       batch_size=flags.batch_size,
+                                       shuffle_buffer=flags.shuffle_buffer,
+                                       cache=flags.cache,
+                                       height=flags.height, width=flags.w)
+    test_ds, n_test = get_image_mask(flags.test, data_root=flags.data_root,
+                                     classes=flags.channels,
+                                     batch_size=flags.batch_size,
+                                     augmentation=False, shuffle=False,
+                                     height=flags.height, width=flags.w)
+
+    train_iter = train_ds.make_initializable_iterator()
+    test_iter = test_ds.make_initializable_iterator()
+
+    # batches go from the iterator straight into the model, `handle` selects
+    # the train or test iterator; X and y can still be fed for inference
+    handle = tf.placeholder(tf.string, shape=[], name="handle")
+    iterator = tf.data.Iterator.from_string_handle(handle, train_ds.output_types,
+                                                   train_ds.output_shapes)
+    X_batch, y_batch = iterator.get_next()
+
+    # X takes images already scaled to [-1, 1], unlike the raw pixel
+    # input of the exported models from `save_folded_model`
+    X = tf.placeholder_with_default(X_batch, shape=[None, flags.height, flags.w, 3],
+                                    name="X_scaled")
+    y = tf.placeholder_with_default(y_batch, shape=[None, flags.height, flags.w, flags.channels],
+                                    name="y")
     mode = tf.placeholder(tf.bool, name="mode")
 
     if flags.channels>1:
@@ -380,52 +690,46 @@ def main(flags):
     else:
         activation = tf.nn.sigmoid
 
+    data_format = flags.data_format
+    if data_format is None:
+        data_format = "channels_first" if tf.test.is_gpu_available() else "channels_last"
+
     pred = make_unet(X, mode,
                      activation=activation,
-                     classes=flags.channels)
+                     classes=flags.channels,
+                     data_format=data_format)
 
-    tf.add_to_collection("inputs", X)
-    tf.add_to_collection("inputs", mode)
+    tf.add_to_collection("scaled_inputs", X)
+    tf.add_to_collection("scaled_inputs", mode)
     tf.add_to_collection("outputs", pred)
     tf.add_to_collection("outputs", y)
 
-    tf.summary.histogram("Predicted_Mask", pred)
+    pred_hist = tf.summary.histogram("Predicted_Mask", pred)
     #tf.summary.tensor_summary("Predicted_Mask", pred)
 
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
 
     with tf.control_dependencies(update_ops):
-        train_op = make_train_op(pred, y, learning_rate=flags.learning_rate)
+        train_op = make_train_op(pred, y, learning_rate=flags.learning_rate,
+                                 mixed_precision=flags.mixed_precision,
+                                 jit=flags.xla)
 
     iou_ = sparse_iou(pred, y)
     tf.add_to_collection("metrics", iou_)
-    tf.summary.scalar("IOU", iou_)
-    IOU_op = tf.Print(iou_, [iou_, mode])
-    #tf.summary.scalar("IOU_print", IOU_op)
-
-    data_root_ = tf.Variable(flags.data_root, trainable=False)
-    train_csv = tf.train.string_input_producer([flags.train])
-    test_csv = tf.train.string_input_producer([flags.test])
-    train_image, train_mask = get_image_mask(train_csv, data_root = data_root_,
-                                            height=flags.height, width=flags.w)
-    test_image, test_mask = get_image_mask(test_csv, data_root = data_root_,
-                                           augmentation=False,
-                                           height=flags.height, width=flags.w)
-
-    X_batch_op, y_batch_op = tf.train.shuffle_batch([train_image, train_mask],
-                                                    batch_size=flags.batch_size,
-                                                    capacity=flags.batch_size * 5,
-                                                    min_after_dequeue=flags.batch_size * 2,
-                                                    allow_smaller_final_batch=True)
-
-    X_test_op, y_test_op = tf.train.batch([test_image, test_mask],
-                                          batch_size=flags.batch_size,
-                                          capacity=flags.batch_size * 2,
-                                          allow_smaller_final_batch=True)
-
-    summary_op = tf.summary.merge_all()
-
-    with tf.Session() as sess:
+    iou_summary = tf.summary.scalar("IOU", iou_)
+    batch_size_op = tf.shape(X)[0]
+
+    # scalars are cheap and logged every step, the histogram of the whole
+    # predicted batch only every `log_every` steps
+    summary_scalar_op = tf.summary.merge([iou_summary])
+    summary_hist_op = tf.summary.merge([pred_hist])
+
+    config = tf.ConfigProto()
+    if flags.xla:
+        # auto-cluster compilable ops (mostly elementwise chains) with XLA
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    with tf.Session(config=config) as sess:
         train_summary_writer = tf.summary.FileWriter(train_logdir, sess.graph)
         test_summary_writer = tf.summary.FileWriter(test_logdir)
 
@@ -450,42 +754,49 @@ def main(flags):
         try:
             global_step = tf.train.get_global_step(sess.graph)
 
-            coord = tf.train.Coordinator()
-            threads = tf.train.start_queue_runners(coord=coord)
+            sess.run([train_iter.initializer, test_iter.initializer])
+            global_step_value = sess.run(global_step)
+            train_handle, test_handle = sess.run([train_iter.string_handle(),
+                                                  test_iter.string_handle()])
 
             for epoch in range(flags.epochs):
 
                 for step in range(0, n_train, flags.batch_size):
 
-                    X_batch, y_batch = sess.run([X_batch_op, y_batch_op])
+                    fetches = [train_op, global_step, summary_scalar_op]
+                    if global_step_value % flags.log_every == 0:
+                        fetches.append(summary_hist_op)
 
-                    _, step_iou, step_summary, global_step_value = sess.run(
-                        [train_op, IOU_op, summary_op, global_step],
-                        feed_dict={X: X_batch,
-                                   y: y_batch,
-                                   mode: True})
+                    results = sess.run(fetches,
+                                       feed_dict={handle: train_handle,
+                                                  mode: True})
 
-                    train_summary_writer.add_summary(step_summary, global_step_value)
+                    global_step_value = results[1]
+                    for step_summary in results[2:]:
+                        train_summary_writer.add_summary(step_summary, global_step_value)
 
                 total_iou = 0
                 for step in range(0, n_test, flags.batch_size):
-                    X_test, y_test = sess.run([X_test_op, y_test_op])
-                    step_iou, step_summary = sess.run(
-                        [IOU_op, summary_op],
-                        feed_dict={X: X_test,
-                                   y: y_test,
+                    step_iou, step_summary, step_size = sess.run(
+                        [iou_, summary_scalar_op, batch_size_op],
+                        feed_dict={handle: test_handle,
                                    mode: False})
 
-                    total_iou += step_iou * X_test.shape[0]
+                    total_iou += step_iou * step_size
 
                     test_summary_writer.add_summary(step_summary, (epoch + 1) * (step + 1))
 
                 if epoch % flags.saveinepochs ==0:
                     saver.save(sess, "{}/model.{}.ckpt".format(flags.ckdir, epoch))
 
+            # export only once training went through
+            save_folded_model(sess, "{}/model.folded.ckpt".format(flags.ckdir),
+                              [None, flags.height, flags.w, 3],
+                              activation=activation, classes=flags.channels,
+                              frozen_path="{}/model.frozen.pb".format(flags.ckdir),
+                              frozen_input_shape=[1, flags.height, flags.w, 3])
+
         finally:
-            coord.request_stop()
-            coord.join(threads)
             saver.save(sess, "{}/model.ckpt".format(flags.ckdir))
 
 
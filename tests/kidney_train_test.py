@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from kidney_train import fold_batch_norm, make_unet, save_folded_model
+
+SHAPE = [2, 16, 16, 3]
+
+
+def data_formats():
+    formats = ["channels_last"]
+    if tf.test.is_gpu_available():
+        # NCHW convolutions have no CPU kernels in TF1
+        formats.append("channels_first")
+    return formats
+
+
+@pytest.fixture
+def images() -> np.ndarray:
+    return np.random.RandomState(0).uniform(0, 255, SHAPE).astype(np.float32)
+
+
+def train_unet(data_format: str):
+    """Builds a U-Net with random (non-trivial) BN statistics
+
+    Returns the session, the raw pixel input, the `mode` placeholder
+    and the prediction.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        X = tf.placeholder(tf.float32, shape=SHAPE, name="X")
+        mode = tf.placeholder(tf.bool, name="mode")
+        pred = make_unet(X * (1. / 127.5) - 1., mode, activation=tf.nn.softmax,
+                         classes=3, data_format=data_format)
+
+        sess = tf.Session(graph=graph)
+        sess.run(tf.global_variables_initializer())
+
+        rng = np.random.RandomState(1)
+        for var in tf.global_variables():
+            name = var.op.name
+            shape = var.get_shape().as_list()
+            if name.endswith("moving_variance") or name.endswith("gamma"):
+                var.load(rng.uniform(0.5, 2., shape), sess)
+            elif name.endswith("moving_mean") or name.endswith("beta"):
+                var.load(rng.normal(0., 0.5, shape), sess)
+
+    return sess, X, mode, pred
+
+
+@pytest.mark.parametrize("data_format", data_formats())
+def test_fold_batch_norm_keeps_output(images, data_format) -> None:
+    """The BN-free graph with folded weights predicts the same as inference mode"""
+
+    sess, X, mode, pred = train_unet(data_format)
+    expected = sess.run(pred, feed_dict={X: images, mode: False})
+
+    values = fold_batch_norm(sess)
+
+    # convs in front of BN are trained without bias, folding adds one
+    trained = [var.op.name for var in sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)]
+    assert "layer1/conv_1/bias" not in trained
+    assert "layer1/conv_1/bias" in values
+
+    with tf.Graph().as_default(), tf.Session() as folded_sess:
+        X_folded = tf.placeholder(tf.float32, shape=SHAPE)
+        pred_folded = make_unet(X_folded * (1. / 127.5) - 1., False,
+                                activation=tf.nn.softmax, classes=3,
+                                batch_norm=False)
+        for var in tf.global_variables():
+            var.load(values[var.op.name], folded_sess)
+
+        result = folded_sess.run(pred_folded, feed_dict={X_folded: images})
+
+    np.testing.assert_allclose(result, expected, atol=1e-4)
+
+
+def test_save_folded_model_exports(images, tmpdir) -> None:
+    """Folded checkpoint and frozen graph take raw pixels and match the model"""
+
+    sess, X, mode, pred = train_unet("channels_last")
+    expected = sess.run(pred, feed_dict={X: images, mode: False})
+
+    ckpt_path = os.path.join(str(tmpdir), "model.folded.ckpt")
+    frozen_path = os.path.join(str(tmpdir), "model.frozen.pb")
+    save_folded_model(sess, ckpt_path, [None] + SHAPE[1:],
+                      activation=tf.nn.softmax, classes=3,
+                      frozen_path=frozen_path, frozen_input_shape=SHAPE)
+
+    with tf.Graph().as_default(), tf.Session() as folded_sess:
+        tf.train.import_meta_graph(ckpt_path + ".meta").restore(folded_sess, ckpt_path)
+        X_folded, = tf.get_collection("inputs")
+        pred_folded, = tf.get_collection("outputs")
+
+        # batch dimension stays free in the checkpoint
+        assert X_folded.get_shape().as_list() == [None] + SHAPE[1:]
+        result = folded_sess.run(pred_folded, feed_dict={X_folded: images})
+
+    np.testing.assert_allclose(result, expected, atol=1e-4)
+
+    graph_def = tf.GraphDef()
+    with open(frozen_path, "rb") as fh:
+        graph_def.ParseFromString(fh.read())
+
+    with tf.Graph().as_default(), tf.Session() as frozen_sess:
+        tf.import_graph_def(graph_def, name="")
+        result = frozen_sess.run("pred:0", feed_dict={"X:0": images})
+
+    np.testing.assert_allclose(result, expected, atol=1e-4)